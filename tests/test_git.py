@@ -1,12 +1,17 @@
 import pytest
 
+import time
+
 from pathlib import Path
 
 from subprocess import run
 
 from tiddlyserver.git import (
     init_repo_if_needed,
+    has_staged_changes,
     commit_files_if_changed,
+    combine_commit_messages,
+    BackgroundCommitter,
 )
 
 
@@ -19,6 +24,33 @@ def test_init_repo_if_needed(tmp_path: Path) -> None:
     assert init_repo_if_needed(directory) is False
 
 
+@pytest.mark.parametrize("object_format", ["sha1", "sha256"])
+def test_has_staged_changes(tmp_path: Path, object_format: str) -> None:
+    directory = tmp_path / "repo"
+    directory.mkdir()
+    run(
+        ["git", "init", "--quiet", f"--object-format={object_format}"],
+        cwd=directory,
+        check=True,
+    )
+    
+    # Before first commit
+    assert has_staged_changes(directory) is False
+    
+    (directory / "file_a").write_text("Hello")
+    run(["git", "add", "file_a"], cwd=directory, check=True)
+    assert has_staged_changes(directory) is True
+    
+    # After a commit
+    run(["git", "commit", "--quiet", "--message", "first"], cwd=directory, check=True)
+    assert has_staged_changes(directory) is False
+    
+    (directory / "file_a").write_text("Hello, world")
+    assert has_staged_changes(directory) is False
+    run(["git", "add", "file_a"], cwd=directory, check=True)
+    assert has_staged_changes(directory) is True
+
+
 def git_status(directory: Path) -> dict[Path, str]:
     output = run(
         ["git", "status", "--porcelain"],
@@ -96,3 +128,126 @@ class TestCommitFilesIfNeeded:
         file_c.unlink()  # Not in repo
         assert commit_files_if_changed(directory, [file_b, file_c], "delete commit") is True
         assert git_status(directory) == {}
+
+    def test_long_message(self, tmp_path: Path) -> None:
+        directory = tmp_path / "repo"
+        directory.mkdir()
+        assert init_repo_if_needed(directory) is True
+        
+        file_a = directory / "file_a"
+        file_a.write_text("Hello")
+        
+        # Longer than Linux's 128 KiB limit on a single argument
+        message = "x" * (256 * 1024)
+        assert commit_files_if_changed(directory, [file_a], message) is True
+        assert git_log(directory) == [message]
+
+
+def test_combine_commit_messages() -> None:
+    assert combine_commit_messages(["foo"]) == "foo"
+    assert combine_commit_messages(["foo", "bar"]) == "2 changes\n\n* foo\n* bar"
+
+
+class TestBackgroundCommitter:
+
+    def test_commit_and_flush(self, tmp_path: Path) -> None:
+        directory = tmp_path / "repo"
+        directory.mkdir()
+        assert init_repo_if_needed(directory) is True
+        
+        file_a = directory / "file_a"
+        file_a.write_text("Hello")
+        file_b = directory / "file_b"
+        file_b.write_text("World")
+        
+        committer = BackgroundCommitter(directory)
+        committer.commit([file_a], "first commit")
+        committer.flush()
+        assert git_status(directory) == {file_b: "??"}
+        assert git_log(directory) == ["first commit"]
+        
+        # Changes are committed on close
+        committer.commit([file_b], "second commit")
+        committer.close()
+        assert git_status(directory) == {}
+        assert git_log(directory) == ["first commit", "second commit"]
+        
+        with pytest.raises(RuntimeError):
+            committer.commit([file_a], "closed")
+
+    def test_coalesces_changes(self, tmp_path: Path) -> None:
+        directory = tmp_path / "repo"
+        directory.mkdir()
+        assert init_repo_if_needed(directory) is True
+        
+        file_a = directory / "file_a"
+        file_a.write_text("Hello")
+        file_b = directory / "file_b"
+        file_b.write_text("World")
+        
+        # Long delay: nothing will be committed until we flush
+        committer = BackgroundCommitter(directory, delay=60, max_delay=60)
+        committer.commit([file_a], "add a")
+        committer.commit([file_b], "add b")
+        committer.commit([file_a], "change a")
+        assert git_status(directory) == {file_a: "??", file_b: "??"}
+        
+        committer.flush()
+        assert git_status(directory) == {}
+        assert git_log(directory) == ["2 changes"]
+        
+        committer.close()
+
+    def test_max_delay(self, tmp_path: Path) -> None:
+        directory = tmp_path / "repo"
+        directory.mkdir()
+        assert init_repo_if_needed(directory) is True
+        
+        file_a = directory / "file_a"
+        file_a.write_text("Hello")
+        
+        # Despite the long delay, the change should be committed (without
+        # flushing) after max_delay
+        committer = BackgroundCommitter(directory, delay=60, max_delay=0.1)
+        committer.commit([file_a], "add a")
+        deadline = time.monotonic() + 10
+        while git_status(directory) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        assert git_log(directory) == ["add a"]
+        
+        committer.close()
+
+    def test_retries_failed_commits(self, tmp_path: Path) -> None:
+        directory = tmp_path / "repo"
+        directory.mkdir()
+        assert init_repo_if_needed(directory) is True
+        
+        file_a = directory / "file_a"
+        file_a.write_text("Hello")
+        file_b = directory / "file_b"
+        file_b.write_text("World")
+        
+        committer = BackgroundCommitter(directory, delay=0.05)
+        
+        # Make committing fail by holding git's index lock. Flushing should
+        # still return.
+        lock = directory / ".git" / "index.lock"
+        lock.touch()
+        committer.commit([file_a], "add a")
+        committer.flush()
+        assert git_status(directory) == {file_a: "??", file_b: "??"}
+        
+        # Once the lock is released, the failed change should be retried
+        # (without flushing) rather than lost
+        lock.unlink()
+        deadline = time.monotonic() + 10
+        while file_a in git_status(directory) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        assert git_log(directory) == ["add a"]
+        
+        committer.commit([file_b], "add b")
+        committer.flush()
+        assert git_status(directory) == {}
+        assert git_log(directory) == ["add a", "add b"]
+        
+        committer.close()
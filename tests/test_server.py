@@ -8,7 +8,16 @@ from pathlib import Path
 
 from flask.testing import FlaskClient
 
-from tiddlyserver.server import create_app, EMPTY_WITH_TIDDLYWEB
+import tiddlyserver.server
+
+from tiddlyserver.tiddler_serdes import scan_tiddler_files, delete_tiddler
+
+from tiddlyserver.server import (
+    create_app,
+    read_empty_html,
+    json_array_response,
+    EMPTY_WITH_TIDDLYWEB,
+)
 
 from test_git import git_log
 
@@ -20,6 +29,33 @@ def tiddler_path(tmp_path: Path) -> Path:
     return path
 
 
+def test_read_empty_html(tmp_path: Path) -> None:
+    filename = tmp_path / "empty.html"
+    filename.write_text("foo")
+    
+    first = read_empty_html(filename)
+    assert first == "foo"
+    
+    # Cached whilst unchanged
+    assert read_empty_html(filename) is first
+    
+    # Re-read when changed
+    filename.write_text("bar!")
+    assert read_empty_html(filename) == "bar!"
+
+
+@pytest.mark.parametrize("values", [[], [1], [{"a": "b"}, 2, "three"]])
+def test_json_array_response(values: list) -> None:
+    response = json_array_response(iter(values))
+    assert response.content_type == "application/json"
+    assert json.loads(response.get_data()) == values
+    
+    # Each value should be sent as a single piece (along with its separator)
+    # rather than the separators being sent separately
+    response = json_array_response(iter(values))
+    assert len(list(response.iter_encoded())) == len(values) + 1
+
+
 class TestNoGit:
 
     @pytest.fixture
@@ -58,6 +94,74 @@ class TestNoGit:
         client.delete("/bags/bag/tiddlers/foobar")
         response = client.get("/recipes/all/tiddlers.json").get_json()
         assert response == []
+    
+    def test_put_title_mismatch(self, client: FlaskClient) -> None:
+        response = client.put(
+            "/recipes/all/tiddlers/foobar",
+            data=json.dumps({"title": "bazqux"}),
+            content_type="application/json",
+        )
+        assert response.status_code == 400
+        
+        # Nothing written
+        response = client.get("/recipes/all/tiddlers.json").get_json()
+        assert response == []
+    
+    @pytest.mark.parametrize("url", ["/", "/recipes/all/tiddlers.json"])
+    def test_tiddler_deleted_during_listing(
+        self,
+        client: FlaskClient,
+        tiddler_path: Path,
+        url: str,
+        monkeypatch: pytest.MonkeyPatch,
+    ) -> None:
+        for title in ["KeptTiddler", "DeletedTiddler"]:
+            client.put(
+                f"/recipes/all/tiddlers/{title}",
+                data=json.dumps({"title": title}),
+                content_type="application/json",
+            )
+        
+        # Simulate a concurrent DELETE landing between the directory being
+        # scanned and the files being read
+        def scan_then_delete(directory: Path) -> list:
+            entries = list(scan_tiddler_files(directory))
+            delete_tiddler(directory, "DeletedTiddler")
+            return entries
+        
+        monkeypatch.setattr(tiddlyserver.server, "scan_tiddler_files", scan_then_delete)
+        
+        response = client.get(url)
+        assert response.status_code == 200
+        data = response.get_data(as_text=True)
+        assert "KeptTiddler" in data
+        assert "DeletedTiddler" not in data
+        
+        # The (streamed) JSON must remain well-formed
+        if url.endswith(".json"):
+            assert [t["title"] for t in json.loads(data)] == ["KeptTiddler"]
+    
+    @pytest.mark.parametrize("url", ["/", "/recipes/all/tiddlers.json"])
+    def test_etag(self, client: FlaskClient, url: str) -> None:
+        response = client.get(url)
+        assert response.status_code == 200
+        etag = response.headers["ETag"]
+        
+        # Unchanged
+        response = client.get(url, headers={"If-None-Match": etag})
+        assert response.status_code == 304
+        assert response.headers["ETag"] == etag
+        assert response.get_data() == b""
+        
+        # Changed
+        client.put(
+            "/recipes/all/tiddlers/foobar",
+            data=json.dumps({"title": "foobar", "text": "Foo, bar, init?"}),
+            content_type="application/json",
+        )
+        response = client.get(url, headers={"If-None-Match": etag})
+        assert response.status_code == 200
+        assert response.headers["ETag"] != etag
 
 
 class TestWithGit:
@@ -67,14 +171,18 @@ class TestWithGit:
         app = create_app(tiddler_path, use_git=True)
         with app.test_client() as client:
             yield client
+        app.config["git_committer"].close()
     
     def test_apis(self, client: FlaskClient, tiddler_path: Path) -> None:
+        git_committer = client.application.config["git_committer"]
+        
         # Add a tiddler
         client.put(
             "/recipes/all/tiddlers/foobar",
             data=json.dumps({"title": "foobar"}),
             content_type="application/json",
         )
+        git_committer.flush()
         assert git_log(tiddler_path) == ["Updated empty.html", "Updated foobar"]
         
         # Add a draft and StoryList (which should be ignored
@@ -88,11 +196,14 @@ class TestWithGit:
             data=json.dumps({"title": "Draft of foo", "draft.of": "foo"}),
             content_type="application/json",
         )
+        git_committer.flush()
         assert git_log(tiddler_path) == ["Updated empty.html", "Updated foobar"]
         
         # Delete the tiddler
         client.delete("/bags/bag/tiddlers/foobar")
+        git_committer.flush()
         assert git_log(tiddler_path) == ["Updated empty.html", "Updated foobar", "Deleted foobar"]
         
         client.delete("/bags/bag/tiddlers/foobar")
+        git_committer.flush()
         assert git_log(tiddler_path) == ["Updated empty.html", "Updated foobar", "Deleted foobar"]
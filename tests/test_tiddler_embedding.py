@@ -6,6 +6,8 @@ from tiddlyserver.tiddler_embedding import (
     HTMLTagOffsetFinder,
     modify_string,
     serialise_as_text_tiddler,
+    UnexpectedHTMLStructureError,
+    find_embedding_offsets,
     embed_tiddlers_into_empty_html,
 )
 
@@ -62,6 +64,16 @@ class TestHTMLTagOffsetFinder:
         assert attrs == {}
         assert string[start:end] == "<li>hello<li>world"
 
+    def test_reset(self) -> None:
+        finder = HTMLTagOffsetFinder([("div", {})])
+        finder.feed("<p>\n\n<div>first</div>")
+        finder.reset()
+        
+        string = "<div>second</div>"
+        finder.feed(string)
+        (((tag, attrs, start, end), ), ) = finder.matches
+        assert string[start:end] == "second"
+
     def test_matching(self) -> None:
         finder = HTMLTagOffsetFinder([
             ("div", {}),
@@ -129,6 +141,25 @@ def test_modify_string(
     assert modify_string(string, insertions, deletions) == exp
 
 
+@pytest.mark.parametrize(
+    "insertions, deletions",
+    [
+        # Overlapping deletions
+        ([], [(0, 2), (1, 3)]),
+        ([], [(1, 3), (0, 2)]),
+        ([], [(1, 2), (1, 3)]),
+        # Insertion within deletion
+        ([(2, "!")], [(1, 3)]),
+    ],
+)
+def test_modify_string_overlaps(
+    insertions: list[tuple[int, str]],
+    deletions: list[tuple[int, int]],
+) -> None:
+    with pytest.raises(ValueError):
+        modify_string("abcd", insertions, deletions)
+
+
 def test_serialise_as_text_tiddler() -> None:
     assert serialise_as_text_tiddler({
         "title": "Hello",
@@ -137,6 +168,21 @@ def test_serialise_as_text_tiddler() -> None:
     }) == '<div title="Hello" escape-me="&quot;quotes&quot;"><pre>you "&amp;" me</pre></div>'
 
 
+def test_find_embedding_offsets() -> None:
+    html = '<title>T</title><noscript>NS</noscript><div id="storeArea"><div>x</div></div>'
+    (
+        (title_start, title_end),
+        (noscript_start, noscript_end),
+        store_area_end,
+    ) = find_embedding_offsets(html)
+    assert html[title_start:title_end] == "T"
+    assert html[noscript_start:noscript_end] == "NS"
+    assert html[store_area_end:] == "</div>"
+    
+    with pytest.raises(UnexpectedHTMLStructureError):
+        find_embedding_offsets("<title>T</title>")
+
+
 def test_embed_tiddlers_into_empty_html() -> None:
     html_in = """
         <html>
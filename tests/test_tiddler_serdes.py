@@ -1,5 +1,9 @@
 import pytest
 
+import os
+
+import threading
+
 from pathlib import Path
 
 from tiddlyserver.tiddler_serdes import (
@@ -13,6 +17,10 @@ from tiddlyserver.tiddler_serdes import (
     write_tiddler,
     read_tiddler,
     read_all_tiddlers,
+    scan_tiddler_files,
+    tiddler_files_fingerprint,
+    write_file_atomically,
+    tiddler_file_cache,
 )
 
 class TestTitleToFilenameStub:
@@ -82,6 +90,9 @@ class TestTitleToFilenameStub:
         ({"foo": "bar\nbaz"}, False),
         # Not tid-safe if have other exciting characters
         ({"foo": "bar\0baz"}, False),
+        ({"foo": "bar\tbaz"}, False),
+        ({"foo": "bar\x7fbaz"}, False),
+        ({"foo": "caf\u00e9"}, False),
         # Also check about field names!
         ({" foo ": "bar"}, False),
         # But don't care about whatever is in text field
@@ -93,6 +104,60 @@ def test_is_tid_safe(tiddler: dict[str, str], exp: bool) -> None:
     assert is_tid_safe(tiddler) is exp
 
 
+def test_write_file_atomically(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    filename = tmp_path / "foo.tid"
+    
+    write_file_atomically(filename, b"Hello")
+    assert filename.read_bytes() == b"Hello"
+    
+    write_file_atomically(filename, b"World")
+    assert filename.read_bytes() == b"World"
+    
+    # On failure after the temporary file has been written, the original is
+    # left intact and the temporary file removed
+    temp_filenames = []
+    
+    def failing_replace(src: Path, dst: Path) -> None:
+        temp_filenames.append(Path(src))
+        assert Path(src).read_bytes() == b"Failed"
+        # Temporary files must not be mistaken for tiddlers
+        assert [entry.name for entry in scan_tiddler_files(tmp_path)] == ["foo.tid"]
+        raise OSError("Simulated failure")
+    
+    monkeypatch.setattr(os, "replace", failing_replace)
+    with pytest.raises(OSError):
+        write_file_atomically(filename, b"Failed")
+    monkeypatch.undo()
+    
+    assert len(temp_filenames) == 1
+    assert not temp_filenames[0].exists()
+    assert filename.read_bytes() == b"World"
+    assert list(tmp_path.iterdir()) == [filename]
+
+
+def test_write_file_atomically_concurrently(tmp_path: Path) -> None:
+    filename = tmp_path / "foo.tid"
+    contents = [b"A" * 10000, b"B" * 10000]
+    errors = []
+    
+    def writer(data: bytes) -> None:
+        try:
+            for _ in range(200):
+                write_file_atomically(filename, data)
+        except Exception as exc:
+            errors.append(exc)
+    
+    threads = [threading.Thread(target=writer, args=(data, )) for data in contents]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    
+    assert errors == []
+    assert filename.read_bytes() in contents
+    assert list(tmp_path.iterdir()) == [filename]
+
+
 def test_serialise_tid_and_deserialise_tid(tmp_path: Path) -> None:
     path = tmp_path / "test.tid"
     
@@ -110,6 +175,35 @@ def test_serialise_tid_and_deserialise_tid(tmp_path: Path) -> None:
     assert deserialise_tid(path, include_text=False) == tiddler_no_text
 
 
+@pytest.mark.parametrize("include_text", [True, False])
+@pytest.mark.parametrize(
+    "content, exp",
+    [
+        # Typical
+        ("title: foo\nbar:  baz \n\nHello\n\nWorld", {"title": "foo", "bar": "baz", "text": "Hello\n\nWorld"}),
+        # Windows line endings
+        ("title: foo\r\n\r\nHello\r\n", {"title": "foo", "text": "Hello\n"}),
+        # No text
+        ("title: foo\n", {"title": "foo", "text": ""}),
+        ("title: foo", {"title": "foo", "text": ""}),
+        # Empty header
+        ("\nHello\n\nWorld", {"text": "Hello\n\nWorld"}),
+        ("", {"text": ""}),
+        # Header lines without a colon are ignored
+        ("title: foo\nbar\nbaz: qux\n\nHello", {"title": "foo", "baz": "qux", "text": "Hello"}),
+    ],
+)
+def test_deserialise_tid(tmp_path: Path, content: str, exp: dict[str, str], include_text: bool) -> None:
+    path = tmp_path / "test.tid"
+    path.write_bytes(content.encode("utf-8"))
+    
+    if not include_text:
+        exp = exp.copy()
+        del exp["text"]
+    
+    assert deserialise_tid(path, include_text) == exp
+
+
 def test_serialise_json_plus_text_and_deserialise_json_plus_text(tmp_path: Path) -> None:
     path = tmp_path / "test.tid"
     
@@ -164,6 +258,9 @@ class TestReadWriteAndDeleteTiddler:
         
         assert read_tiddler(directory, tid_tiddler["title"]) == tid_tiddler
         assert read_tiddler(directory, json_tiddler["title"]) == json_tiddler
+        
+        with pytest.raises(FileNotFoundError):
+            read_tiddler(directory, "Does not exist")
     
     def test_delete_tiddler(self, tmp_path: Path) -> None:
         directory = tmp_path / "tiddlers"
@@ -179,6 +276,7 @@ class TestReadWriteAndDeleteTiddler:
         
         assert len(delete_tiddler(directory, tid_tiddler["title"])) == 1
         assert len(delete_tiddler(directory, json_tiddler["title"])) == 2
+        assert delete_tiddler(directory, json_tiddler["title"]) == []
         
         assert len(list(directory.glob("**/*.*"))) == 0
     
@@ -195,3 +293,83 @@ class TestReadWriteAndDeleteTiddler:
         tiddlers = sorted(read_all_tiddlers(directory), key=lambda t: t["title"])
         
         assert tiddlers == [json_tiddler, tid_tiddler]
+
+    def test_read_all_tiddlers_skips_hidden_directories(self, tmp_path: Path) -> None:
+        directory = tmp_path / "tiddlers"
+        directory.mkdir()
+        
+        tiddler = {"title": "foo/bar", "text": "Hello"}
+        write_tiddler(directory, tiddler)
+        
+        hidden = directory / ".git"
+        hidden.mkdir()
+        serialise_tid({"title": "Not a tiddler"}, hidden / "nope.tid")
+        
+        assert list(read_all_tiddlers(directory)) == [tiddler]
+
+    def test_read_all_tiddlers_cache(self, tmp_path: Path) -> None:
+        directory = tmp_path / "tiddlers"
+        directory.mkdir()
+        
+        tiddler = {"title": "foo", "text": "Hello"}
+        (filename, ) = write_tiddler(directory, tiddler)
+        
+        assert list(read_all_tiddlers(directory)) == [tiddler]
+        assert list(read_all_tiddlers(directory, include_text=False)) == [{"title": "foo"}]
+        
+        # Modifying the returned value must not affect the cache
+        next(read_all_tiddlers(directory))["title"] = "bar"
+        assert list(read_all_tiddlers(directory)) == [tiddler]
+        
+        # Changed via write_tiddler
+        tiddler = {"title": "foo", "text": "World"}
+        write_tiddler(directory, tiddler)
+        assert list(read_all_tiddlers(directory)) == [tiddler]
+        
+        # Changed behind our back
+        filename.write_text("title: foo\n\nChanged!")
+        assert list(read_all_tiddlers(directory)) == [{"title": "foo", "text": "Changed!"}]
+        
+        # Deleted behind our back: dropped from the cache
+        assert str(filename) in tiddler_file_cache
+        filename.unlink()
+        assert list(read_all_tiddlers(directory)) == []
+        assert str(filename) not in tiddler_file_cache
+    
+    def test_tiddler_files_fingerprint(self, tmp_path: Path) -> None:
+        directory = tmp_path / "tiddlers"
+        directory.mkdir()
+        
+        def fingerprint() -> str:
+            return tiddler_files_fingerprint(scan_tiddler_files(directory))
+        
+        empty = fingerprint()
+        
+        # Added
+        (filename, ) = write_tiddler(directory, {"title": "foo", "text": "Hello"})
+        added = fingerprint()
+        assert added != empty
+        
+        # Unchanged
+        assert fingerprint() == added
+        
+        # Modified
+        filename.write_text("title: foo\n\nChanged!")
+        modified = fingerprint()
+        assert modified not in (empty, added)
+        
+        # Text of .json tiddler modified
+        write_tiddler(directory, {"title": "foo", " bar": "baz"})
+        before = fingerprint()
+        filename.with_suffix(".text").write_text("Changed!")
+        assert fingerprint() != before
+        
+        # Removed
+        delete_tiddler(directory, "foo")
+        assert fingerprint() == empty
+        
+        # Removed after scanning
+        write_tiddler(directory, {"title": "foo", "text": "Hello"})
+        entries = list(scan_tiddler_files(directory))
+        delete_tiddler(directory, "foo")
+        assert tiddler_files_fingerprint(entries) == empty
@@ -3,11 +3,32 @@ A (fairly crude) automatic mechanism to automatically track changes to tiddlers
 in a directory in a Git respository.
 """
 
+from typing import Optional
+
+import os
+
+import shutil
+
+import atexit
+
+import logging
+
+import threading
+
+import time
+
 from pathlib import Path
 
 from subprocess import run, DEVNULL
 
 
+GIT = shutil.which("git") or "git"
+"""
+The git executable, located once up-front to save a PATH search every time git
+is run.
+"""
+
+
 def init_repo_if_needed(directory: Path) -> bool:
     """
     If the specified directory is not a git repository (or in one), create a
@@ -15,8 +36,16 @@ def init_repo_if_needed(directory: Path) -> bool:
     
     Returns True iff a new repository was initialised.
     """
+    # Fast path: look for a .git directory (or file, in the case of worktrees
+    # and submodules) without running git.
+    directory = directory.resolve()
+    for parent in [directory, *directory.parents]:
+        if (parent / ".git").exists():
+            return False
+    
+    # Fall back on asking git (e.g. in case GIT_DIR is set)
     p = run(
-        ["git", "rev-parse", "--is-inside-work-tree"],
+        [GIT, "rev-parse", "--is-inside-work-tree"],
         cwd=directory,
         stdout=DEVNULL,
         stderr=DEVNULL,
@@ -25,48 +54,318 @@ def init_repo_if_needed(directory: Path) -> bool:
         # We're in a git repository, stop here
         return False
     else:
-        p = run(["git", "init"], cwd=directory)
+        p = run([GIT, "init"], cwd=directory)
         p.check_returncode()
         return True
 
 
+def has_staged_changes(directory: Path) -> bool:
+    """
+    Return True iff the index differs from HEAD.
+    """
+    # NB: Using plumbing command which reports differences solely via its exit
+    # status: 0 for no changes, 1 for changes.
+    returncode = run(
+        [GIT, "diff-index", "--cached", "--quiet", "HEAD", "--"],
+        cwd=directory,
+        stderr=DEVNULL,
+    ).returncode
+    if returncode in (0, 1):
+        return returncode == 1
+    
+    # Otherwise, HEAD probably doesn't exist yet (i.e. nothing has been
+    # commited), so compare against the empty tree instead. NB: The empty
+    # tree's hash is computed (rather than hard-coded) since it depends on the
+    # repository's object format (SHA-1 or SHA-256).
+    tree = run(
+        [GIT, "write-tree"],
+        cwd=directory,
+        capture_output=True,
+        check=True,
+        text=True,
+    ).stdout.strip()
+    empty_tree = run(
+        [GIT, "hash-object", "-t", "tree", "--stdin"],
+        input="",
+        cwd=directory,
+        capture_output=True,
+        check=True,
+        text=True,
+    ).stdout.strip()
+    return tree != empty_tree
+
+
 def commit_files_if_changed(directory: Path, filenames: list[Path], message: str) -> bool:
     """
-    Commit the named files to the repository.
+    Commit the named files to the repository. The filenames must be given as
+    paths within the specified directory (e.g. ``directory / "foo.tid"``).
     
     .. warning::
     
         If any changes are already staged, these will be blindly commited too!
     """
-    to_add = [f.resolve() for f in filenames if f.is_file()]
-    to_remove = [f.resolve() for f in filenames if not f.is_file()]
-    if to_add:
-        run(
-            ["git", "add", "--"] + to_add,
-            cwd=directory,
-            check=True,
-        )
-    if to_remove:
-        run(
-            ["git", "rm", "--ignore-unmatch", "--"] + to_remove,
-            cwd=directory,
-            check=True,
-        )
+    if not filenames:
+        return False
     
-    changes_to_commit = run(
-        ["git", "status", "--porcelain", "--untracked-files=no"],
+    # Stage additions and removals in one go. With both --add and --remove,
+    # update-index adds (or updates) files which exist and removes from the
+    # index those which don't (silently ignoring untracked files), saving a
+    # separate 'git add' and 'git rm' invocation. The (NUL-separated) paths
+    # are fed via stdin so any number of files may be staged by one process.
+    run(
+        [GIT, "update-index", "--add", "--remove", "-z", "--stdin"],
+        input=b"".join(os.fsencode(f.relative_to(directory)) + b"\0" for f in filenames),
         cwd=directory,
-        capture_output=True,
         check=True,
-        text=True,
-    ).stdout != ""
+    )
+    
+    changes_to_commit = has_staged_changes(directory)
     
     if changes_to_commit:
+        # NB: Message passed via stdin since messages combining many changes
+        # (see BackgroundCommitter) may exceed the OS's argument length limit
         run(
-            ["git", "commit", "--quiet", "--message", message],
+            [GIT, "commit", "--quiet", "--file=-"],
+            input=message.encode("utf-8"),
             cwd=directory,
             check=True,
         )
         return True
     else:
         return False
+
+
+def combine_commit_messages(messages: list[str]) -> str:
+    """
+    Combine the messages of several changes into a single commit message.
+    """
+    if len(messages) == 1:
+        return messages[0]
+    else:
+        return "\n".join(
+            [f"{len(messages)} changes", ""]
+            + [f"* {message}" for message in messages]
+        )
+
+
+class BackgroundCommitter:
+    """
+    Commits files to a git repository from a background thread so that callers
+    (e.g. request handlers) need not wait for git to run.
+    
+    Changes are committed once no further changes have been submitted for
+    ``delay`` seconds, with all of the files changed in the meantime combined
+    into a single commit. This avoids producing a separate commit for every one
+    of a rapid series of saves (e.g. the PUT and DELETE which make up a rename).
+    So that a continuous stream of changes can't postpone committing forever,
+    changes are always committed within ``max_delay`` seconds of the first
+    uncommitted change. Outstanding changes are committed when the committer is
+    closed (which happens automatically when the interpreter exits).
+    
+    If committing fails (e.g. because another git process holds the index
+    lock), the changes are retried later with exponential backoff (up to
+    :py:attr:`max_retry_delay` seconds) rather than being dropped.
+    """
+    
+    max_retry_delay: float = 60.0
+    """The maximum delay between attempts to commit after a failure."""
+    
+    _directory: Path
+    
+    _delay: float
+    
+    _max_delay: float
+    
+    _condition: threading.Condition
+    """Guards all of the state below."""
+    
+    _pending: dict[Path, str]
+    """
+    The files waiting to be committed, along with the message given with the
+    most recent change to each.
+    """
+    
+    _first_change: float
+    """The :py:func:`time.monotonic` time of the oldest pending change."""
+    
+    _last_change: float
+    """The :py:func:`time.monotonic` time of the most recent change."""
+    
+    _attempts: int
+    """The number of attempts to commit started so far."""
+    
+    _completed: int
+    """The number of attempts to commit finished (successfully or not) so far."""
+    
+    _flush_target: int
+    """
+    Attempts up to (and including) this number should be started without
+    waiting (i.e. because :py:meth:`flush` was called).
+    """
+    
+    _failures: int
+    """The number of consecutive failed attempts to commit."""
+    
+    _retry_at: float
+    """
+    The :py:func:`time.monotonic` time before which no attempt to commit
+    should be made following a failure.
+    """
+    
+    _busy: bool
+    """True while the background thread is committing changes."""
+    
+    _closed: bool
+    
+    _thread: threading.Thread
+    
+    def __init__(self, directory: Path, delay: float = 0.5, max_delay: float = 5.0) -> None:
+        self._directory = directory
+        self._delay = delay
+        self._max_delay = max_delay
+        
+        self._condition = threading.Condition()
+        self._pending = {}
+        self._first_change = 0.0
+        self._last_change = 0.0
+        self._attempts = 0
+        self._completed = 0
+        self._flush_target = 0
+        self._failures = 0
+        self._retry_at = 0.0
+        self._busy = False
+        self._closed = False
+        
+        self._thread = threading.Thread(
+            target=self._run,
+            name=f"BackgroundCommitter({directory})",
+            daemon=True,
+        )
+        self._thread.start()
+        
+        atexit.register(self.close)
+    
+    def commit(self, filenames: list[Path], message: str) -> None:
+        """
+        Schedule the named files to be committed (if changed) with the given
+        message. Returns immediately.
+        """
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("BackgroundCommitter has been closed")
+            now = time.monotonic()
+            if not self._pending:
+                self._first_change = now
+            for filename in filenames:
+                self._pending[filename] = message
+            self._last_change = now
+            self._condition.notify_all()
+    
+    def flush(self) -> None:
+        """
+        Commit all changes scheduled so far without further delay, blocking
+        until this is complete.
+        
+        If the attempt to commit fails, this returns anyway (the changes remain
+        scheduled and will be retried later).
+        """
+        with self._condition:
+            # NB: Any attempt already in progress may not include all changes
+            # scheduled so far so wait for the next one.
+            target = self._attempts + 1
+            self._flush_target = max(self._flush_target, target)
+            self._condition.notify_all()
+            self._condition.wait_for(
+                lambda: (
+                    (not self._pending and not self._busy)
+                    or self._completed >= target
+                )
+            )
+    
+    def close(self) -> None:
+        """
+        Make a final attempt to commit any outstanding changes and stop the
+        background thread.
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
+        atexit.unregister(self.close)
+    
+    def _take_pending(self) -> Optional[dict[Path, str]]:
+        """
+        Wait until it is time to commit the pending changes, then take them.
+        Returns None once closed and no changes remain.
+        """
+        with self._condition:
+            while True:
+                if not self._pending:
+                    # Nothing left for any flush to wait for
+                    self._flush_target = self._attempts
+                    if self._closed:
+                        return None
+                    self._condition.wait()
+                    continue
+                
+                deadline = max(
+                    min(
+                        self._last_change + self._delay,
+                        self._first_change + self._max_delay,
+                    ),
+                    self._retry_at,
+                )
+                remaining = deadline - time.monotonic()
+                flush_requested = self._attempts < self._flush_target
+                if remaining > 0 and not flush_requested and not self._closed:
+                    self._condition.wait(remaining)
+                    continue
+                
+                pending = self._pending
+                self._pending = {}
+                self._busy = True
+                self._attempts += 1
+                return pending
+    
+    def _run(self) -> None:
+        while (pending := self._take_pending()) is not None:
+            messages = list(dict.fromkeys(pending.values()))
+            try:
+                commit_files_if_changed(
+                    self._directory,
+                    list(pending),
+                    combine_commit_messages(messages),
+                )
+            except Exception:
+                with self._condition:
+                    closed = self._closed
+                    if not closed:
+                        # Put the changes back to be retried, without
+                        # overwriting any newer changes to the same files
+                        pending.update(self._pending)
+                        self._pending = pending
+                        self._failures += 1
+                        retry_delay = min(
+                            self._delay * 2**self._failures,
+                            self.max_retry_delay,
+                        )
+                        self._retry_at = time.monotonic() + retry_delay
+                if closed:
+                    logging.exception(
+                        f"Failed to commit changes to {self._directory}; "
+                        f"giving up on {', '.join(map(str, pending))}"
+                    )
+                else:
+                    logging.exception(
+                        f"Failed to commit changes to {self._directory}; "
+                        f"retrying in {retry_delay:.1f}s"
+                    )
+            else:
+                with self._condition:
+                    self._failures = 0
+                    self._retry_at = 0.0
+            finally:
+                with self._condition:
+                    self._busy = False
+                    self._completed += 1
+                    self._condition.notify_all()
@@ -15,15 +15,29 @@ import argparse
 
 import json
 
-import re
-
-from html import unescape
-
 from tiddlyserver.tiddler_embedding import HTMLTagOffsetFinder
 
 from tiddlyserver.server import EMPTY_WITH_TIDDLYWEB
 
 
+def unescape_tiddlywiki_html(string: str) -> str:
+    """
+    Reverse the HTML escaping applied by TiddlyWiki's ``htmlEncode`` to
+    tiddler text in the store area.
+    
+    TiddlyWiki only ever escapes the characters ``&<>"`` so we don't need the
+    full generality (and expense) of :py:func:`html.unescape`. NB: ``&amp;``
+    must be replaced last.
+    """
+    return (
+        string
+        .replace("&quot;", '"')
+        .replace("&lt;", "<")
+        .replace("&gt;", ">")
+        .replace("&amp;", "&")
+    )
+
+
 def extract_core_official_plugin_library_tiddler_and_version(
     empty_html_path: Path,
 ) -> tuple[dict[str, str], str]:
@@ -34,8 +48,13 @@ def extract_core_official_plugin_library_tiddler_and_version(
     finder.feed(empty_html)
     
     _tag, attrs, start, end = finder.matches[0][0]
-    core_pre_tag = empty_html[start:end]
-    core_json = unescape(re.fullmatch(r"\s*<pre>(.*)</pre>\s*$", core_pre_tag, re.DOTALL).group(1))
+    
+    # Extract the (multi-megabyte) contents of the <pre> tag. NB: plain
+    # substring searches are used since these are much cheaper than running a
+    # regex over the whole thing.
+    pre_start = empty_html.index("<pre>", start, end) + len("<pre>")
+    pre_end = empty_html.rindex("</pre>", pre_start, end)
+    core_json = unescape_tiddlywiki_html(empty_html[pre_start:pre_end])
     core = json.loads(core_json)
     
     return (
@@ -94,7 +113,7 @@ def main() -> None:
     
     args = parser.parse_args()
     
-    json.dump([make_plugin(args.empty_html)], args.output.open("w"))
+    args.output.write_text(json.dumps([make_plugin(args.empty_html)]))
 
 
 if __name__ == "__main__":
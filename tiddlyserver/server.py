@@ -3,20 +3,35 @@ An :py:mod:`flask` based webserver implementing (a bare-bones subset of) the
 TiddlyWeb API.
 """
 
+from typing import Any, Iterable, Iterator
+
+import sys
+
 import argparse
 
+import json
+
 import inspect
 
+import signal
+
+import threading
+
 import shutil
 
+from functools import lru_cache
+
 from pathlib import Path
 
-from flask import Flask, Blueprint, Response, current_app, jsonify, abort, request
+from flask import Flask, Blueprint, Response, current_app, abort, request
 
 import tiddlyserver
 
 from tiddlyserver.tiddler_serdes import (
-    read_all_tiddlers,
+    scan_tiddler_files,
+    tiddler_files_fingerprint,
+    prune_tiddler_file_cache,
+    read_tiddler_files,
     read_tiddler,
     write_tiddler,
     delete_tiddler,
@@ -29,6 +44,7 @@ from tiddlyserver.tiddler_hash import tiddler_hash
 from tiddlyserver.git import (
     init_repo_if_needed,
     commit_files_if_changed,
+    BackgroundCommitter,
 )
 
 EMPTY_WITH_TIDDLYWEB = Path(inspect.getfile(tiddlyserver)).parent / "empty_with_tiddlyweb.html"
@@ -37,6 +53,42 @@ EMPTY_WITH_TIDDLYWEB = Path(inspect.getfile(tiddlyserver)).parent / "empty_with_
 bp = Blueprint("tiddlyserver", __name__)
 
 
+JSON_SEPARATORS = (",", ":")
+"""Separators for compact JSON responses."""
+
+
+def json_response(value: Any) -> Response:
+    """
+    Produce a JSON response.
+    
+    Unlike :py:func:`flask.jsonify` this serialises the value in a single call
+    to the (C-accelerated) :py:func:`json.dumps` without going through Flask's
+    JSON provider machinery or sorting keys. Output is compact (no whitespace
+    after separators).
+    """
+    return Response(json.dumps(value, separators=JSON_SEPARATORS), content_type="application/json")
+
+
+def json_array_response(values: Iterable[Any]) -> Response:
+    """
+    Produce a streamed JSON response containing an array of values.
+    
+    Each value is serialised and sent as it is produced by the iterable rather
+    than building the whole array (and its serialisation) in memory first.
+    """
+    # NB: Each value is yielded along with its preceding separator (or the
+    # opening bracket) since servers (e.g. waitress) may send every item
+    # yielded as a separate HTTP chunk, each with its own framing overhead.
+    def generate() -> Iterator[str]:
+        prefix = "["
+        for value in values:
+            yield prefix + json.dumps(value, separators=JSON_SEPARATORS)
+            prefix = ","
+        yield "[]" if prefix == "[" else "]"
+    
+    return Response(generate(), content_type="application/json")
+
+
 def tiddler_git_filter(tiddler: dict[str, str]) -> bool:
     """
     Return True only for Tiddlers which should be included in Git.
@@ -51,25 +103,77 @@ def tiddler_git_filter(tiddler: dict[str, str]) -> bool:
     )
 
 
+@lru_cache(maxsize=4)
+def _read_empty_html(filename: Path, mtime_ns: int, size: int) -> str:
+    """
+    Read the empty.html file. Cached on the file's modification time and size
+    (which are otherwise unused) so that the file is only re-read when it
+    changes.
+    """
+    return filename.read_text()
+
+
+def read_empty_html(filename: Path) -> str:
+    """
+    Read the named empty.html file, returning a cached copy if the file hasn't
+    changed since it was last read.
+    
+    Since the same string object is returned each time, the (cached) parse of
+    the file performed by
+    :py:func:`tiddlyserver.tiddler_embedding.find_embedding_offsets` can be
+    looked-up cheaply too.
+    """
+    stat = filename.stat()
+    return _read_empty_html(filename, stat.st_mtime_ns, stat.st_size)
+
+
+def not_modified_response(etag: str) -> Response:
+    """
+    Produce a '304 Not Modified' response for a request whose If-None-Match
+    header matched the (weak) etag given.
+    """
+    response = Response(status=304)
+    response.set_etag(etag, weak=True)
+    return response
+
+
 @bp.route('/')
 def get_index():
     """
     Return a copy of the empty.html with all tiddlers in the tiddler directory
     pre-loaded.
+    
+    A (weak) ETag is sent which changes whenever the empty.html or any tiddler
+    file changes. When a client presents a matching ETag, the (comparatively
+    expensive) generation of the page is skipped entirely.
     """
     empty_html_filename: Path = current_app.config["empty_html_filename"]
     tiddler_dir: Path = current_app.config["tiddler_dir"]
     
-    empty_html = empty_html_filename.read_text()
-    
-    tiddlers = sorted(
-        read_all_tiddlers(tiddler_dir),
-        key=lambda t: t.get("title", ""),
+    # NB: The tiddler files are listed (and the ETag computed) before they are
+    # read so that, should they change in the meantime, the content sent is
+    # never older than the ETag suggests.
+    entries = list(scan_tiddler_files(tiddler_dir))
+    prune_tiddler_file_cache(tiddler_dir, entries)
+    empty_html_stat = empty_html_filename.stat()
+    etag = "{}-{}-{}".format(
+        tiddler_files_fingerprint(entries),
+        empty_html_stat.st_mtime_ns,
+        empty_html_stat.st_size,
     )
+    if request.if_none_match.contains_weak(etag):
+        return not_modified_response(etag)
+    
+    empty_html = read_empty_html(empty_html_filename)
+    
+    # NB: embed_tiddlers_into_empty_html sorts the tiddlers itself
+    tiddlers = list(read_tiddler_files(entries))
     
     html = embed_tiddlers_into_empty_html(empty_html, tiddlers)
     
-    return Response(html, content_type="text/html")
+    response = Response(html, content_type="text/html")
+    response.set_etag(etag, weak=True)
+    return response
 
 
 @bp.route('/status')
@@ -78,12 +182,12 @@ def get_status():
     Bare-minimum response which minimises UI cruft like usernames and login
     screens.
     """
-    return {
+    return json_response({
         "space": {"recipe": "all"},
         "username": "GUEST",
         "read_only": False,
         "anonymous": True,
-    }
+    })
 
 
 @bp.route('/recipes/all/tiddlers.json')
@@ -96,8 +200,20 @@ def get_skinny_tiddlers():
     describing a tiddler's fields.
     """
     tiddler_dir = current_app.config["tiddler_dir"]
-    skinny_tiddlers = list(read_all_tiddlers(tiddler_dir, include_text=False))
-    return jsonify(skinny_tiddlers)
+    
+    # NB: As in get_index, the ETag is computed before the files are read
+    entries = list(scan_tiddler_files(tiddler_dir))
+    prune_tiddler_file_cache(tiddler_dir, entries)
+    etag = tiddler_files_fingerprint(entries)
+    if request.if_none_match.contains_weak(etag):
+        return not_modified_response(etag)
+    
+    # NB: Files are read lazily as the response is streamed (i.e. after the
+    # status has been sent) so any deleted in the meantime must be skipped
+    # (as read_tiddler_files does) to keep the array well-formed.
+    response = json_array_response(read_tiddler_files(entries, include_text=False))
+    response.set_etag(etag, weak=True)
+    return response
 
 
 @bp.route('/recipes/all/tiddlers/<path:title>')
@@ -114,7 +230,7 @@ def get_tiddler(title):
     tiddler_dir = current_app.config["tiddler_dir"]
     
     try:
-        return jsonify(read_tiddler(tiddler_dir, title))
+        return json_response(read_tiddler(tiddler_dir, title))
     except FileNotFoundError:
         abort(404)
 
@@ -124,7 +240,8 @@ def put_tiddler(title):
     Store (or modify) a tiddler.
     """
     tiddler_dir = current_app.config["tiddler_dir"]
-    use_git = current_app.config["use_git"]
+    write_lock = current_app.config["write_lock"]
+    git_committer = current_app.config["git_committer"]
     
     tiddler = request.get_json()
     
@@ -133,6 +250,10 @@ def put_tiddler(title):
     if "tags" in tiddler:
         tiddler["tags"] = " ".join(f"[[{tag}]]" for tag in tiddler.get("tags", []))
     
+    # Sanity check (NB: not an assert since those are stripped by python -O)
+    if title != tiddler.get("title"):
+        abort(400)
+    
     # Mandatory for TiddlyWeb but (but unused by this implementation)
     tiddler["bag"] = "bag"
     
@@ -141,12 +262,10 @@ def put_tiddler(title):
     hash = tiddler_hash(tiddler)
     tiddler["revision"] = revision = hash
     
-    # Sanity check
-    assert title == tiddler.get("title")
-    
-    changed_files = write_tiddler(tiddler_dir, tiddler)
-    if use_git and tiddler_git_filter(tiddler):
-        commit_files_if_changed(tiddler_dir, changed_files, f"Updated {title}")
+    with write_lock:
+        changed_files = write_tiddler(tiddler_dir, tiddler)
+    if git_committer is not None and tiddler_git_filter(tiddler):
+        git_committer.commit(changed_files, f"Updated {title}")
     
     etag = f'"bag/{title}/{revision}:{hash}"'
     headers = {"Etag": etag}
@@ -159,12 +278,14 @@ def remove_tiddler(title):
     Delete a tiddler.
     """
     tiddler_dir = current_app.config["tiddler_dir"]
-    use_git = current_app.config["use_git"]
+    write_lock = current_app.config["write_lock"]
+    git_committer = current_app.config["git_committer"]
     
-    deleted_files = delete_tiddler(tiddler_dir, title)
+    with write_lock:
+        deleted_files = delete_tiddler(tiddler_dir, title)
     
-    if use_git:
-        commit_files_if_changed(tiddler_dir, deleted_files, f"Deleted {title}")
+    if git_committer is not None:
+        git_committer.commit(deleted_files, f"Deleted {title}")
     
     if deleted_files:
         return ""
@@ -182,7 +303,9 @@ def create_app(tiddler_dir: Path, use_git: bool) -> Flask:
         The directory in which tiddlers will be stored.
     use_git : bool
         If True, will ensure the tiddler directory is a git repository and
-        auto-commit changes to that repository.
+        auto-commit changes to that repository. Commits are made in the
+        background (see :py:class:`tiddlyserver.git.BackgroundCommitter`),
+        available as the ``git_committer`` config value.
     """
     # Create tiddler directory and empty HTML if either doesn't exist yet
     if not tiddler_dir.is_dir():
@@ -204,6 +327,12 @@ def create_app(tiddler_dir: Path, use_git: bool) -> Flask:
     app.config["empty_html_filename"] = empty_html_filename
     app.config["tiddler_dir"] = tiddler_dir.resolve()
     app.config["use_git"] = use_git
+    # Serialises changes to tiddler files when requests are handled by
+    # multiple threads.
+    app.config["write_lock"] = threading.Lock()
+    app.config["git_committer"] = (
+        BackgroundCommitter(tiddler_dir.resolve()) if use_git else None
+    )
     return app
 
 
@@ -249,6 +378,16 @@ def main():
         """
     )
     
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=4,
+        help="""
+            The number of threads to use to handle requests. Defaults to
+            %(default)d.
+        """
+    )
+    
     parser.add_argument(
         "--no-git", "-G",
         action="store_true",
@@ -265,9 +404,13 @@ def main():
     
     app = create_app(tiddler_dir, use_git)
     
+    # Exit cleanly on SIGTERM so that any outstanding background git commits
+    # are completed before we stop.
+    signal.signal(signal.SIGTERM, lambda _signum, _frame: sys.exit(0))
+    
     from waitress import serve
     print(f"Serving on: http://{args.host}:{args.port}/")
-    serve(app, host=args.host, port=args.port, threads=1)
+    serve(app, host=args.host, port=args.port, threads=args.threads)
 
 
 if __name__ == "__main__":
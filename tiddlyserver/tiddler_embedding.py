@@ -6,6 +6,8 @@ from typing import Iterable, Optional
 
 import logging
 
+from functools import lru_cache
+
 from html import escape
 from html.parser import HTMLParser
 
@@ -44,8 +46,16 @@ class HTMLTagOffsetFinder(HTMLParser):
         Find the start and end offsets of all tags listed in the 'to_find'
         list (given as lower-case-tag-name, attribute-dict pairs.
         """
-        super().__init__()
+        # NB: Set before calling HTMLParser.__init__ since it calls reset()
         self._to_find = [(tag, set(attrs.items())) for tag, attrs in to_find]
+        super().__init__()
+    
+    def reset(self) -> None:
+        """
+        Reset the parser, discarding any matches found so far, so that it may
+        be reused to parse another document.
+        """
+        super().reset()
         
         self._chars_fed = 0
         self._lineno_to_offset = [0]
@@ -54,10 +64,13 @@ class HTMLTagOffsetFinder(HTMLParser):
         self.matches = [[] for _ in self._to_find]
     
     def feed(self, string: str) -> None:
-        # Find the line start offsets for this batch of data
-        for i, c in enumerate(string):
-            if c == "\n":
-                self._lineno_to_offset.append(self._chars_fed + i + 1)
+        # Find the line start offsets for this batch of data (NB: using
+        # str.find to scan for newlines is far faster than a Python loop over
+        # every character)
+        i = string.find("\n")
+        while i != -1:
+            self._lineno_to_offset.append(self._chars_fed + i + 1)
+            i = string.find("\n", i + 1)
         self._chars_fed += len(string)
         
         super().feed(string)
@@ -98,24 +111,29 @@ def modify_string(
     values may be inserted at a given point and will be inserted one after
     another in the order given in that case.
     """
-    ranges = sorted([(i, i) for i, s in insertions] + deletions)
-    for (s1, e1), (s2, e2) in zip(ranges[:-1], ranges[1:]):
-        if s2 < e1:
-            raise ValueError("Overlapping insertions or deletions")
-    
+    # Build the output in a single pass through the string (copying each
+    # unchanged span exactly once). NB: Sort is stable so insertions at the
+    # same offset remain in the order given (and come before any deletion
+    # starting there).
     parts = []
-    for change in sorted(deletions + insertions[::-1], key=lambda x: x[0], reverse=True):
+    position = 0
+    for change in sorted(insertions + deletions, key=lambda x: x[0]):
+        # Any change starting before the end of the previous deletion overlaps
+        # it.
+        if change[0] < position:
+            raise ValueError("Overlapping insertions or deletions")
+        
         if isinstance(change[1], str):  # Insertion
             offset, substring = change
-            parts.append(string[offset:])
+            parts.append(string[position:offset])
             parts.append(substring)
-            string = string[:offset]
+            position = offset
         else:  # Deletion
             start, end = change
-            parts.append(string[end:])
-            string = string[:start]
-    parts.append(string)
-    return "".join(reversed(parts))
+            parts.append(string[position:start])
+            position = end
+    parts.append(string[position:])
+    return "".join(parts)
 
 
 def get_title_and_subtitle(tiddlers: Iterable[dict[str, str]]) -> tuple[Optional[str], Optional[str]]:
@@ -130,6 +148,10 @@ def get_title_and_subtitle(tiddlers: Iterable[dict[str, str]]) -> tuple[Optional
             title = tiddler.get("text")
         elif tiddler.get("title") == "$:/SiteSubtitle":
             subtitle = tiddler.get("text")
+        
+        # Stop early once both have been found
+        if title is not None and subtitle is not None:
+            break
     
     return (title, subtitle)
 
@@ -156,9 +178,16 @@ class UnexpectedHTMLStructureError(ValueError):
     """
 
 
-def embed_tiddlers_into_empty_html(html: str, tiddlers: list[dict[str, str]]) -> str:
+@lru_cache(maxsize=2)
+def find_embedding_offsets(html: str) -> tuple[tuple[int, int], tuple[int, int], int]:
     """
-    Given the HTML of an empty TiddlyWiki, embed the provided tiddlers.
+    Find the locations in the HTML of an empty TiddlyWiki where tiddlers are to
+    be embedded. Returns a tuple ((title_start, title_end), (noscript_start,
+    noscript_end), store_area_end) giving character offsets of the contents of
+    the <title>, <noscript> and tiddler store area.
+    
+    Parsing a TiddlyWiki is comparatively slow so the results are cached: the
+    same empty.html is usually used over and over again.
     """
     # Find the <title> tag, Javascript disabled message (which contains a stale
     # list of tiddlers) and tiddler store area.
@@ -180,6 +209,19 @@ def embed_tiddlers_into_empty_html(html: str, tiddlers: list[dict[str, str]]) ->
     _tag, _attrs, noscript_start, noscript_end = finder.matches[1][0]
     _tag, _attrs, _store_area_start, store_area_end = finder.matches[2][0]
     
+    return ((title_start, title_end), (noscript_start, noscript_end), store_area_end)
+
+
+def embed_tiddlers_into_empty_html(html: str, tiddlers: list[dict[str, str]]) -> str:
+    """
+    Given the HTML of an empty TiddlyWiki, embed the provided tiddlers.
+    """
+    (
+        (title_start, title_end),
+        (noscript_start, noscript_end),
+        store_area_end,
+    ) = find_embedding_offsets(html)
+    
     insertions = []
     deletions = []
     
@@ -206,7 +248,7 @@ def embed_tiddlers_into_empty_html(html: str, tiddlers: list[dict[str, str]]) ->
     serialised_tiddlers = "\n".join(
         map(
             serialise_as_text_tiddler,
-            sorted(tiddlers, key=lambda t: t.get("title")),
+            sorted(tiddlers, key=lambda t: t.get("title", "")),
         )
     )
     insertions.append((store_area_end, serialised_tiddlers))
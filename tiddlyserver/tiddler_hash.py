@@ -2,18 +2,19 @@
 Compute a hash of a tiddler's contents.
 """
 
-from hashlib import md5
+import json
+
+from hashlib import sha256
 
 
 def tiddler_hash(tiddler: dict[str, str]) -> str:
     """
     Compute a hash of the contents of a Tiddler.
     
-    This hash is the MD5 sum of the concatenated (binary) MD5 checksums of each
-    UTF-8 encoded field and value in turn, in alphabetical order.
+    This hash is the SHA-256 sum of the tiddler serialised as compact JSON with
+    its fields in alphabetical order, encoded as UTF-8.
     """
-    md5_sum = md5()
-    for field, value in sorted(tiddler.items()):
-        md5_sum.update(md5(field.encode("utf-8")).digest())
-        md5_sum.update(md5(value.encode("utf-8")).digest())
-    return md5_sum.hexdigest()
+    # NB: Serialising everything up-front means the hash function is called
+    # just once rather than once per field and value.
+    serialised = json.dumps(tiddler, sort_keys=True, separators=(",", ":"))
+    return sha256(serialised.encode("utf-8")).hexdigest()
@@ -2,21 +2,34 @@
 Routines for serialising and deserialising tiddlers on disk.
 """
 
-from typing import TextIO, Iterable
+from typing import TextIO, Iterable, Optional
+
+import os
 
 import re
 
 import json
 
-from string import ascii_letters, digits, punctuation
+from functools import lru_cache
 
 from pathlib import Path
 
 from hashlib import md5
 
+from uuid import uuid4
+
 from itertools import chain
 
 
+path_separators_re = re.compile(r"[/\\]+")
+unsafe_characters_re = re.compile(r"[^a-zA-Z0-9 _-]+")
+windows_reserved_filename_re = re.compile(
+    r"^(CON|PRN|AUX|NUL|COM[1-9]|LPT[1-9])$",
+    flags=re.IGNORECASE,
+)
+
+
+@lru_cache(maxsize=4096)
 def title_to_filename_stub(title: str) -> Path:
     """
     Convert a title into a safe filename.
@@ -42,9 +55,12 @@ def title_to_filename_stub(title: str) -> Path:
     on popular operating systems. The final step ensures that filenames are
     distinct even when some letters have been replaced (and that case changes
     result in a distinct filename.
+    
+    Results are cached since the same titles are typically converted over and
+    over again (e.g. on every read and write of a given tiddler).
     """
     # Split on any slash
-    parts = re.split(r"[/\\]+", title)
+    parts = path_separators_re.split(title)
     
     # Special case: replace $: with system
     if parts[0] == "$:":
@@ -52,18 +68,18 @@ def title_to_filename_stub(title: str) -> Path:
     
     # Replace all (runs of) nontrivial characters with _
     parts = [
-        re.sub(r"[^a-zA-Z0-9 _-]+", "_", part)
+        unsafe_characters_re.sub("_", part)
         for part in parts
     ]
     
     # Suffix all reserved Windows filenames with _
     parts = [
-        re.sub(r"^(CON|PRN|AUX|NUL|COM[1-9]|LPT[1-9])$", r"\1_", part, flags=re.IGNORECASE)
+        windows_reserved_filename_re.sub(r"\1_", part)
         for part in parts
     ]
     
     # Remove trailing whitespace (and remove any empty path components)
-    parts = [part.strip() for part in parts if part.strip()]
+    parts = [stripped for part in parts if (stripped := part.strip())]
     if not parts:
         parts.append("")
     
@@ -71,13 +87,9 @@ def title_to_filename_stub(title: str) -> Path:
     title_hash = md5(title.encode("utf-8")).hexdigest()[:7].lower()
     parts[-1] = f"{parts[-1]}_{title_hash}".lstrip("_")
     
-    return Path(*parts)
-
-
-tid_safe_characters = ascii_letters + digits + punctuation + " "
-tid_safe_characters_re = re.compile(
-    "(" + "|".join(re.escape(c) for c in tid_safe_characters) + ")*"
-)
+    # NB: Parts have been sanitised (and contain no separators) so can be
+    # joined directly, which is cheaper than having Path parse each part.
+    return Path(os.sep.join(parts))
 
 
 def is_tid_safe(tiddler: dict[str, str]) -> bool:
@@ -86,48 +98,102 @@ def is_tid_safe(tiddler: dict[str, str]) -> bool:
     *.tid format file.
     """
     for field, value in tiddler.items():
-        if field != "text":
-            for string in [field, value]:
-                # Cannot cope with trailing whitespace
-                if string.strip() != string:
-                    return False
-                
-                # Check for unsupported characters (e.g. newlines)
-                if not tid_safe_characters_re.fullmatch(string):
-                    return False
+        if field == "text":
+            continue
+        
+        # Cannot cope with leading/trailing whitespace or anything other than
+        # printable ASCII (i.e. letters, digits, punctuation and spaces; no
+        # newlines). NB: Cheapest checks first: strip only examines the ends
+        # of the string, and the (short) field before the (maybe long) value.
+        if not (
+            field.strip() == field
+            and field.isascii()
+            and field.isprintable()
+            and value.strip() == value
+            and value.isascii()
+            and value.isprintable()
+        ):
+            return False
     
     return True
 
 
+def write_file_atomically(filename: Path, data: bytes) -> None:
+    """
+    Write data to a file such that readers only ever see either the old or
+    new contents in full, never a partially written file.
+    
+    The data is written to a temporary file alongside the target which is then
+    renamed over the top of it.
+    """
+    # NB: The temporary file has a unique name so that concurrent writers of
+    # the same file (e.g. in other processes) can't clobber each other's
+    # temporary files. It is created exclusively (rather than using
+    # tempfile.mkstemp) so that it gets the usual umask-governed permissions
+    # rather than mkstemp's 0600. The '.tmp' suffix ensures it is never
+    # mistaken for a tiddler file by scan_tiddler_files.
+    temp_filename = filename.with_name(f"{filename.name}.{uuid4().hex}.tmp")
+    f = temp_filename.open("xb")
+    try:
+        with f:
+            f.write(data)
+        os.replace(temp_filename, filename)
+    except BaseException:
+        temp_filename.unlink(missing_ok=True)
+        raise
+
+
 def serialise_tid(tiddler: dict[str, str], filename: Path) -> None:
     """
     Serialise a tiddler into a .tid file.
     """
-    with filename.open("w", encoding="utf-8") as f:
-        for field, value in sorted(tiddler.items()):
-            if field != "text":
-                f.write(f"{field}: {value}\n")
-        f.write("\n")
-        f.write(tiddler.get("text", ""))
+    # NB: The whole file is built up-front and written as bytes in one go
+    # which is substantially faster than many small writes via a text-mode
+    # file object.
+    lines = [
+        f"{field}: {value}\n"
+        for field, value in sorted(tiddler.items())
+        if field != "text"
+    ]
+    lines.append("\n")
+    lines.append(tiddler.get("text", ""))
+    write_file_atomically(filename, "".join(lines).encode("utf-8"))
 
 
 def deserialise_tid(filename: Path, include_text: bool = True) -> dict[str, str]:
     """
     Deserialise a tiddler from a .tid file.
+    
+    The file consists of a header of 'field: value' lines (lines without a
+    colon are ignored) followed by a blank line and then the text.
     """
     tiddler = {}
     with filename.open("r", encoding="utf-8") as f:
-        for line in f:
+        if include_text:
+            # NB: Reading the whole file in one go and splitting it is much
+            # cheaper than iterating over it line-by-line and then reading the
+            # rest.
+            content = f.read()
+            if content.startswith("\n"):  # Empty header
+                header, text = "", content[1:]
+            else:
+                header, _, text = content.partition("\n\n")
+            lines = header.split("\n")
+        else:
+            # Read line-by-line, stopping at the end of the header
+            lines = f
+        
+        for line in lines:
+            if line == "\n":  # End of header
+                break
             field, colon, value = line.partition(":")
             if colon:
                 tiddler[field.strip()] = value.strip()
-            else:
-                break
-        
-        if include_text:
-            tiddler["text"] = f.read()
-        
-        return tiddler
+    
+    if include_text:
+        tiddler["text"] = text
+    
+    return tiddler
 
 
 def serialise_json_plus_text(tiddler: dict[str, str], filename: Path) -> None:
@@ -135,11 +201,20 @@ def serialise_json_plus_text(tiddler: dict[str, str], filename: Path) -> None:
     Serialise a tiddler into a .json and .text file. The `.json` filename must
     be given as the argument.
     """
-    tiddler = tiddler.copy()
-    with filename.with_suffix(".text").open("w", encoding="utf-8") as f:
-        f.write(tiddler.pop("text", ""))
-    with filename.open("w", encoding="utf-8") as f:
-        json.dump(tiddler, f)
+    # NB: The .text file is written first so that anything reading the new
+    # .json file will also find the new text.
+    write_file_atomically(
+        filename.with_suffix(".text"),
+        tiddler.get("text", "").encode("utf-8"),
+    )
+    # NB: json.dumps uses the C encoder whilst json.dump falls back on a (much
+    # slower) pure Python implementation
+    write_file_atomically(
+        filename,
+        json.dumps(
+            {field: value for field, value in tiddler.items() if field != "text"}
+        ).encode("utf-8"),
+    )
 
 
 def deserialise_json_plus_text(filename: Path, include_text: bool = True) -> dict[str, str]:
@@ -151,8 +226,9 @@ def deserialise_json_plus_text(filename: Path, include_text: bool = True) -> dic
     if include_text:
         with filename.with_suffix(".text").open("r", encoding="utf-8") as f:
             tiddler["text"] = f.read()
-    with filename.open("r", encoding="utf-8") as f:
-        tiddler.update(json.load(f))
+    # NB: json.loads accepts (UTF-8) bytes directly, avoiding the overhead of
+    # a text-mode file object
+    tiddler.update(json.loads(filename.read_bytes()))
     return tiddler
 
 
@@ -160,16 +236,37 @@ def delete_tiddler(directory: Path, title: str) -> list[Path]:
     """
     Delete the tiddler file(s) associated with the named tiddler, if it exists.
     
+    Returns the full filenames of any deleted files.
+    """
+    return delete_tiddler_files(directory / title_to_filename_stub(title))
+
+
+def delete_tiddler_files(
+    filename_stub: Path,
+    suffixes: tuple[str, ...] = (".tid", ".json", ".text"),
+) -> list[Path]:
+    """
+    Delete the tiddler file(s) with the given filename stub (i.e. the tiddler
+    directory joined with the output of :py:func:`title_to_filename_stub`), if
+    any exist. Optionally only files with the listed suffixes are deleted.
+    
     Returns the full filenames of any deleted files.
     """
     out = []
     
-    filename_stub = directory / title_to_filename_stub(title)
-    for suffix in [".tid", ".json", ".text"]:
-        filename = filename_stub.with_suffix(suffix)
-        if filename.is_file():
-            out.append(filename)
-            filename.unlink()
+    # NB: Candidate filenames are built by string concatenation which is much
+    # cheaper than Path.with_suffix (filename stubs never contain a '.').
+    filename_stub_str = str(filename_stub)
+    for suffix in suffixes:
+        filename = filename_stub_str + suffix
+        # NB: Just attempt the deletion rather than checking whether the file
+        # exists first (saving a stat per suffix)
+        try:
+            os.unlink(filename)
+        except FileNotFoundError:
+            continue
+        out.append(Path(filename))
+        tiddler_file_cache.pop(filename, None)
     
     return out
 
@@ -180,32 +277,25 @@ def write_tiddler(directory: Path, tiddler: dict[str, str]) -> list[Path]:
     
     Returns the full filenames of any deleted or created files.
     """
-    # Delete any previous tiddler (we delete rather than overwriting because
-    # changing the tiddler may change whether it is stored in a single tid file
-    # or in json+text files.
-    title = tiddler.get("title", "")
-    out = delete_tiddler(directory, title)
-    
-    filename_stub = directory / title_to_filename_stub(title)
-    
+    filename_stub = directory / title_to_filename_stub(tiddler.get("title", ""))
     filename_stub.parent.mkdir(parents=True, exist_ok=True)
     
+    # Write the new file(s), atomically replacing any previous version of the
+    # tiddler in the same format, then delete any files left over from a
+    # previous version in the other format (i.e. changing the tiddler may
+    # change whether it is stored in a single tid file or in json+text files).
+    # NB: Done in this order so that the tiddler never disappears, even
+    # momentarily.
     if is_tid_safe(tiddler):
         filename = filename_stub.with_suffix(".tid")
         serialise_tid(tiddler, filename)
-        if filename not in out:
-            out.append(filename)
+        out = [filename]
+        out.extend(delete_tiddler_files(filename_stub, (".json", ".text")))
     else:
         json_filename = filename_stub.with_suffix(".json")
-        text_filename = filename_stub.with_suffix(".text")
-        
         serialise_json_plus_text(tiddler, json_filename)
-        
-        if json_filename not in out:
-            out.append(json_filename)
-        
-        if text_filename not in out:
-            out.append(text_filename)
+        out = [json_filename, filename_stub.with_suffix(".text")]
+        out.extend(delete_tiddler_files(filename_stub, (".tid", )))
     
     return out
 
@@ -218,22 +308,175 @@ def read_tiddler(directory: Path, title: str) -> dict[str, str]:
     """
     filename_stub = directory / title_to_filename_stub(title)
 
-    tid_filename = filename_stub.with_suffix(".tid")
-    if tid_filename.is_file():
-        return deserialise_tid(tid_filename)
+    # NB: Just attempt to read each file rather than checking whether it exists
+    # first (saving a stat per file)
+    try:
+        return deserialise_tid(filename_stub.with_suffix(".tid"))
+    except FileNotFoundError:
+        pass
+    
+    try:
+        return deserialise_json_plus_text(filename_stub.with_suffix(".json"))
+    except FileNotFoundError:
+        raise FileNotFoundError(
+            f"No .tid or .json file could be found for tiddler '{title}'"
+        ) from None
+
+
+def scan_tiddler_files(directory: Path) -> Iterable[os.DirEntry]:
+    """
+    Recursively find all .tid and .json tiddler files in the named directory,
+    yielding a :py:class:`os.DirEntry` for each.
     
-    json_filename = filename_stub.with_suffix(".json")
-    if json_filename.is_file():
-        return deserialise_json_plus_text(json_filename)
+    Hidden directories (e.g. ``.git``) are skipped since
+    :py:func:`title_to_filename_stub` never produces names starting with a
+    dot.
+    """
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                if not entry.name.startswith("."):
+                    yield from scan_tiddler_files(entry.path)
+            elif entry.name.endswith((".tid", ".json")) and entry.is_file():
+                yield entry
+
+
+tiddler_file_cache: dict[str, tuple[tuple, dict[str, str]]] = {}
+"""
+Cache of tiddlers read by :py:func:`read_tiddler_file`, indexed by filename.
+Each entry is a (stat_key, tiddler) pair where stat_key identifies the version
+of the file(s) the tiddler was read from (see :py:func:`stat_key`).
+"""
+
+
+def stat_key(stat: os.stat_result) -> tuple[int, int, int]:
+    """
+    Return an (inode, mtime_ns, size) tuple for a file which changes whenever
+    the file does.
+    """
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+def tiddler_file_key(entry: os.DirEntry) -> Optional[tuple]:
+    """
+    Return a tuple for a .tid or .json file (as found by
+    :py:func:`scan_tiddler_files`) which changes whenever the file (or any
+    accompanying .text file) does.
     
-    raise FileNotFoundError(f"No .tid or .json file could be found for tiddler '{title}'")
+    Returns None if the file no longer exists (e.g. the tiddler was deleted
+    after the directory was scanned).
+    """
+    # NB: scandir doesn't supply the inode number or modification time up
+    # front, so the first call to entry.stat() (which makes a syscall) is
+    # where a vanished file shows up. The result is then cached on the entry
+    # and later calls (e.g. from read_tiddler_file after the ETag was
+    # computed) reuse that same snapshot.
+    try:
+        key: tuple = stat_key(entry.stat())
+    except FileNotFoundError:
+        return None
+    if entry.name.endswith(".json"):
+        text_filename = entry.path[:-len(".json")] + ".text"
+        try:
+            key += stat_key(os.stat(text_filename))
+        except FileNotFoundError:
+            pass
+    return key
+
+
+def tiddler_files_fingerprint(entries: Iterable[os.DirEntry]) -> str:
+    """
+    Return a hash identifying the current version of a set of tiddler files
+    (as found by :py:func:`scan_tiddler_files`). The hash changes whenever a
+    file is added, removed or modified.
+    
+    Only the files' metadata is used so this is much cheaper than reading
+    them. Files which no longer exist are left out.
+    """
+    fingerprint = md5()
+    for entry in entries:
+        key = tiddler_file_key(entry)
+        if key is None:
+            continue
+        fingerprint.update(os.fsencode(entry.path) + b"\0")
+        fingerprint.update(repr(key).encode("ascii"))
+    return fingerprint.hexdigest()
+
+
+def read_tiddler_file(entry: os.DirEntry, include_text: bool = True) -> dict[str, str]:
+    """
+    Read a tiddler from a .tid or .json file (as found by
+    :py:func:`scan_tiddler_files`), reusing the result of a previous read if
+    the file (and any accompanying .text file) has not changed since.
+    
+    Raises a :py:exc:`FileNotFoundError` if the file no longer exists.
+    """
+    is_tid = entry.name.endswith(".tid")
+    key = tiddler_file_key(entry)
+    if key is None:
+        raise FileNotFoundError(f"Tiddler file {entry.path} no longer exists")
+    
+    cached_key, tiddler = tiddler_file_cache.get(entry.path, (None, None))
+    if cached_key != key:
+        deserialise = deserialise_tid if is_tid else deserialise_json_plus_text
+        if not include_text:
+            # Don't populate the cache since that would require reading the
+            # (possibly large) text too
+            return deserialise(Path(entry.path), include_text=False)
+        tiddler = deserialise(Path(entry.path))
+        tiddler_file_cache[entry.path] = (key, tiddler)
+    
+    # NB: Always return a copy so that callers can't modify the cache
+    if include_text:
+        return tiddler.copy()
+    else:
+        return {field: value for field, value in tiddler.items() if field != "text"}
+
+
+def prune_tiddler_file_cache(directory: Path, entries: Iterable[os.DirEntry]) -> None:
+    """
+    Remove any :py:data:`tiddler_file_cache` entries for files within the
+    named directory which were not found by a fresh scan of it (i.e. the
+    entries given, as found by :py:func:`scan_tiddler_files`).
+    
+    This prevents tiddlers deleted behind our back (e.g. by a git checkout)
+    from staying in memory forever.
+    """
+    prefix = os.path.join(directory, "")
+    found = {entry.path for entry in entries}
+    # NB: Iterate over a copy since other threads may be modifying the cache
+    for filename in list(tiddler_file_cache):
+        if filename.startswith(prefix) and filename not in found:
+            tiddler_file_cache.pop(filename, None)
+
+
+def read_tiddler_files(
+    entries: Iterable[os.DirEntry],
+    include_text: bool = True,
+) -> Iterable[dict[str, str]]:
+    """
+    Read the tiddlers from a series of files (as found by
+    :py:func:`scan_tiddler_files`) using :py:func:`read_tiddler_file`.
+    
+    Files which have been deleted since they were found (e.g. by a concurrent
+    request) are skipped.
+    """
+    for entry in entries:
+        try:
+            yield read_tiddler_file(entry, include_text)
+        except FileNotFoundError:
+            continue
 
 
 def read_all_tiddlers(directory: Path, include_text: bool = True) -> Iterable[dict[str, str]]:
     """
     Read all of the tiddlers in the named directory.
+    
+    Tiddlers are cached (see :py:func:`read_tiddler_file`) so that unchanged
+    files need not be re-read and parsed every time.
     """
-    for tid_filename in directory.glob("**/*.tid"):
-        yield deserialise_tid(tid_filename, include_text)
-    for json_filename in directory.glob("**/*.json"):
-        yield deserialise_json_plus_text(json_filename, include_text)
+    # NB: A single scandir-based walk visits each directory once and gets file
+    # types for free from the directory listing.
+    entries = list(scan_tiddler_files(directory))
+    prune_tiddler_file_cache(directory, entries)
+    return read_tiddler_files(entries, include_text)